@@ -0,0 +1,184 @@
+"""Tests for polygon windowing and batching in wcs_downloader."""
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+import rasterio
+import shapely
+from rasterio.transform import from_origin
+from rasterio.windows import Window, WindowError
+
+from wcs_downloader import (
+    BatchMember,
+    group_polygons,
+    load_polygons,
+    mask_and_save,
+    polygon_window,
+    process_source_cog,
+)
+
+# 100 x 100 coverage at 1 m with its top-left corner at (500000, 7400100)
+ORIGIN_X = 500000.0
+ORIGIN_Y = 7400100.0
+SIZE = 100
+TRANSFORM = from_origin(ORIGIN_X, ORIGIN_Y, 1.0, 1.0)
+
+
+@pytest.fixture
+def coverage(tmp_path):
+    """A float32 coverage whose pixel values are their column index."""
+    path = tmp_path / "coverage.tif"
+    data = np.tile(np.arange(SIZE, dtype=np.float32), (SIZE, 1))
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=SIZE,
+        height=SIZE,
+        count=1,
+        dtype="float32",
+        crs="EPSG:25833",
+        transform=TRANSFORM,
+        nodata=-9999,
+    ) as dst:
+        dst.write(data, 1)
+    return path
+
+
+def member(tmp_path, polygon):
+    return BatchMember(
+        index=0,
+        bbox=tuple(polygon.bounds),
+        polygon_wkb=shapely.to_wkb(polygon),
+        output_file=tmp_path / "out.tif",
+    )
+
+
+def test_polygon_window_keeps_partial_edge_pixels():
+    # Column 5 (center x = 5.5) lies inside a box spanning x 3.4 to 5.8
+    bbox = (ORIGIN_X + 3.4, ORIGIN_Y - 12, ORIGIN_X + 5.8, ORIGIN_Y - 2)
+    assert polygon_window(bbox, TRANSFORM, SIZE, SIZE) == Window(3, 2, 3, 10)
+
+
+def test_polygon_window_sub_pixel_box_gets_one_pixel():
+    bbox = (ORIGIN_X + 20.1, ORIGIN_Y - 20.5, ORIGIN_X + 20.5, ORIGIN_Y - 20.1)
+    assert polygon_window(bbox, TRANSFORM, SIZE, SIZE) == Window(20, 20, 1, 1)
+
+
+def test_polygon_window_pixel_aligned_box_is_exact():
+    bbox = (ORIGIN_X + 0.1 * 30, ORIGIN_Y - 0.1 * 70, ORIGIN_X + 0.1 * 70, ORIGIN_Y - 0.1 * 30)
+    assert polygon_window(bbox, TRANSFORM, SIZE, SIZE) == Window(3, 3, 4, 4)
+
+
+def test_polygon_window_clipped_to_raster():
+    bbox = (ORIGIN_X - 5, ORIGIN_Y - 10, ORIGIN_X + 5, ORIGIN_Y + 5)
+    assert polygon_window(bbox, TRANSFORM, SIZE, SIZE) == Window(0, 0, 5, 10)
+
+
+def test_polygon_window_outside_raster_raises():
+    bbox = (ORIGIN_X + 200, ORIGIN_Y - 10, ORIGIN_X + 210, ORIGIN_Y)
+    with pytest.raises(WindowError):
+        polygon_window(bbox, TRANSFORM, SIZE, SIZE)
+
+
+def test_mask_and_save_keeps_partial_edge_pixels(tmp_path, coverage):
+    polygon = shapely.box(ORIGIN_X + 3.4, ORIGIN_Y - 12, ORIGIN_X + 5.8, ORIGIN_Y - 2)
+    with rasterio.open(coverage) as src:
+        result = mask_and_save(src, member(tmp_path, polygon), "float32")
+
+    assert result.success, result.error_message
+    with rasterio.open(tmp_path / "out.tif") as out:
+        assert out.shape == (10, 3)
+        assert out.transform.c == ORIGIN_X + 3
+        assert out.read(1)[0].tolist() == [3, 4, 5]
+
+
+def test_mask_and_save_masks_pixels_outside_polygon(tmp_path, coverage):
+    polygon = shapely.Polygon(
+        [(ORIGIN_X, ORIGIN_Y - 10), (ORIGIN_X + 10, ORIGIN_Y - 10), (ORIGIN_X, ORIGIN_Y)]
+    )
+    with rasterio.open(coverage) as src:
+        result = mask_and_save(src, member(tmp_path, polygon), "float32")
+
+    assert result.success, result.error_message
+    with rasterio.open(tmp_path / "out.tif") as out:
+        data = out.read(1)
+        assert out.shape == (10, 10)
+        assert data[0, 0] == 0
+        assert data[0, 9] == out.nodata
+        assert data[9, 0] == 0
+
+
+def test_mask_and_save_sub_pixel_polygon(tmp_path, coverage):
+    polygon = shapely.box(ORIGIN_X + 20.1, ORIGIN_Y - 20.5, ORIGIN_X + 20.5, ORIGIN_Y - 20.1)
+    with rasterio.open(coverage) as src:
+        result = mask_and_save(src, member(tmp_path, polygon), "float32")
+
+    assert result.success, result.error_message
+    with rasterio.open(tmp_path / "out.tif") as out:
+        assert out.shape == (1, 1)
+
+
+@pytest.mark.parametrize(
+    ("resolution", "edge_shape"),
+    [(1.0, (10, 3)), (0.5, (20, 6))],
+    ids=["native", "warped"],
+)
+def test_process_source_cog_windows(tmp_path, coverage, resolution, edge_shape):
+    edge = shapely.box(ORIGIN_X + 3.4, ORIGIN_Y - 12, ORIGIN_X + 5.8, ORIGIN_Y - 2)
+    sub_pixel = shapely.box(ORIGIN_X + 20.1, ORIGIN_Y - 20.5, ORIGIN_X + 20.5, ORIGIN_Y - 20.1)
+    members = [
+        BatchMember(
+            index=i,
+            bbox=tuple(polygon.bounds),
+            polygon_wkb=shapely.to_wkb(polygon),
+            output_file=tmp_path / f"out_{i}.tif",
+        )
+        for i, polygon in enumerate([edge, sub_pixel])
+    ]
+
+    results = process_source_cog(str(coverage), resolution, members, "float32")
+
+    assert all(result.success for result in results), results
+    with rasterio.open(tmp_path / "out_0.tif") as out:
+        assert out.shape == edge_shape
+    with rasterio.open(tmp_path / "out_1.tif") as out:
+        assert out.shape == (1, 1)
+
+
+def test_group_polygons_disabled_returns_singletons():
+    bounds = np.array([[0, 0, 10, 10], [5, 5, 15, 15]], dtype=float)
+    positions = np.arange(len(bounds))
+    assert group_polygons(bounds, positions, 1.0, 0) == [[0], [1]]
+
+
+def test_group_polygons_groups_within_batch_size():
+    rng = np.random.default_rng(0)
+    mins = rng.uniform(0, 1000, size=(200, 2))
+    bounds = np.hstack([mins, mins + rng.uniform(1, 20, size=(200, 2))])
+    positions = np.arange(len(bounds))
+    batch_pixels = 100
+
+    groups = group_polygons(bounds, positions, 1.0, batch_pixels)
+
+    assert sorted(pos for group in groups for pos in group) == positions.tolist()
+    assert len(groups) < len(bounds)
+    for group in groups:
+        spans = bounds[group, 2:].max(axis=0) - bounds[group, :2].min(axis=0)
+        assert (spans <= batch_pixels).all()
+
+
+def test_group_polygons_keeps_distant_polygons_apart():
+    bounds = np.array([[0, 0, 10, 10], [5000, 5000, 5010, 5010], [2, 2, 8, 8]], dtype=float)
+    positions = np.arange(len(bounds))
+    groups = group_polygons(bounds, positions, 1.0, 100)
+    assert sorted(sorted(group) for group in groups) == [[0, 2], [1]]
+
+
+def test_load_polygons_requires_geo_metadata(tmp_path):
+    path = tmp_path / "plain.parquet"
+    wkb = shapely.to_wkb(np.array([shapely.box(ORIGIN_X, ORIGIN_Y - 10, ORIGIN_X + 10, ORIGIN_Y)]))
+    pq.write_table(pa.table({"geometry": wkb}), path)
+    with pytest.raises(ValueError, match="Missing geo metadata"):
+        load_polygons(path)
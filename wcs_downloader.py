@@ -6,30 +6,99 @@ Downloads DTM rasters from Geonorge WCS service for polygons in a parquet file.
 Supports parallel processing, error logging, and resume capability.
 """
 
+import asyncio
 import csv
+import json
 import math
+import os
+import shutil
 import tempfile
 import threading
 import time
-import warnings
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from dataclasses import dataclass, field
 from datetime import datetime
+from enum import Enum
 from pathlib import Path
 from typing import Annotated
 
 # Default maximum pixels per dimension to prevent huge requests
 DEFAULT_MAX_PIXELS = 10000
 
-# Suppress geoutils deprecation warnings
-warnings.filterwarnings("ignore", category=DeprecationWarning, module="geoutils")
-warnings.filterwarnings("ignore", message="No nodata set")
+# Default concurrency: downloads are latency-bound, masking is bounded by cores
+DEFAULT_NET_WORKERS = 16
+DEFAULT_CPU_WORKERS = os.cpu_count() or 1
+
+# Default WCS request rate limit in requests per second, per download worker
+DEFAULT_RATE_PER_WORKER = 2.0
+
+# Error log file name in the output directory, and how many failures to show inline
+ERROR_LOG_NAME = "failed_polygons.csv"
+FAILED_PREVIEW_LIMIT = 5
+
+# NoData value for output rasters when the WCS coverage does not define one
+DEFAULT_NODATA = -9999
+
+# Output GeoTIFF layout: tile size and internal overview decimation factors
+BLOCK_SIZE = 512
+OVERVIEW_FACTORS = [2, 4, 8, 16]
+
+# Slack in pixels when snapping polygon bounds to whole pixels, so floating
+# point error on a pixel edge does not add or drop a row or column
+PIXEL_EPSILON = 1e-6
+
+# Reusable arrays kept per worker: data, mask and NoData arrays for the two
+# most recent raster sizes
+BUFFER_CACHE_SIZE = 6
+
+# Height units per integer step for quantized output types. int16 decimetres
+# cover -3276.7 m to 3276.7 m, enough for any terrain in Norway.
+OUTPUT_SCALES = {"int16": 0.1}
+
+# Default maximum pixels per dimension of a batched request (0 disables batching)
+DEFAULT_BATCH_PIXELS = 0
+
+# GDAL block cache in MB. rasterize falls back to a slow algorithm when the
+# cache is smaller than the output, so size it for max_pixels rasters.
+GDAL_CACHEMAX_MB = "1024"
+os.environ.setdefault("GDAL_CACHEMAX", GDAL_CACHEMAX_MB)
+
+# HTTP settings for WCS requests
+HTTP_TIMEOUT = 60.0
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5
+RETRY_STATUS_CODES = {502, 503, 504}
+STREAM_CHUNK_SIZE = 1 << 20
+
+# GDAL settings for efficient HTTP range reads from a remote source COG
+COG_GDAL_OPTIONS = {
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+    "GDAL_HTTP_MULTIPLEX": "YES",
+    "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",
+    "VSI_CACHE": "TRUE",
+}
+
+# Size estimate of a downloaded coverage (float32 GeoTIFF), used to bound temp files
+COVERAGE_BYTES_PER_PIXEL = 4
 
 import geopandas as gpd
-import geoutils as gu
+import httpx
+import numpy as np
+import numpy.typing as npt
+import pyarrow.parquet as pq
+import rasterio
+import shapely
 import typer
-from pyproj import CRS
-from owslib.wcs import WebCoverageService
+from affine import Affine
+from pyproj import CRS, Transformer
+from rasterio.enums import Resampling
+from rasterio.features import rasterize
+from rasterio.io import DatasetReader, MemoryFile
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import calculate_default_transform
+from rasterio.windows import Window, from_bounds
 from rich.console import Console
 from rich.progress import (
     BarColumn,
@@ -41,11 +110,21 @@ from rich.progress import (
 )
 from rich.table import Table
 
-# Thread-local storage for WCS connections (one per thread)
-thread_local = threading.local()
-
 console = Console()
 
+# Per-worker cache of reusable arrays, see get_buffer
+buffer_cache = threading.local()
+
+# Per-worker open source COG dataset, see open_source_cog
+source_cache = threading.local()
+
+
+class OutputDtype(str, Enum):
+    """Data type of the output rasters."""
+
+    float32 = "float32"
+    int16 = "int16"
+
 
 @dataclass
 class DownloadResult:
@@ -58,6 +137,16 @@ class DownloadResult:
     error_message: str | None = None
 
 
+@dataclass
+class BatchMember:
+    """A polygon to extract from a downloaded coverage."""
+
+    index: int
+    bbox: tuple[float, float, float, float]
+    polygon_wkb: bytes
+    output_file: Path
+
+
 @dataclass
 class FailedPolygon:
     """Details of a failed polygon download for error logging."""
@@ -72,189 +161,758 @@ class FailedPolygon:
     timestamp: str = field(default_factory=lambda: datetime.now().isoformat())
 
 
-def get_wcs_connection(wcs_url: str) -> WebCoverageService:
-    """Get or create a thread-local WCS connection."""
-    if not hasattr(thread_local, "wcs"):
-        thread_local.wcs = WebCoverageService(wcs_url, version="1.0.0")
-    return thread_local.wcs
+class TokenBucket:
+    """
+    Async token bucket limiting the request rate across all downloads.
+
+    Tokens refill continuously at `rate` per second up to `capacity`, so short
+    bursts are allowed while the long-run rate never exceeds `rate`.
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """Wait until a token is available and take it."""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def create_client(workers: int) -> httpx.AsyncClient:
+    """
+    Create an async HTTP client whose connection pool is shared by all downloads.
+
+    HTTP/2 lets concurrent requests share one multiplexed connection; servers
+    without HTTP/2 support fall back to pooled HTTP/1.1 connections.
+    """
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=workers, max_keepalive_connections=workers),
+        timeout=httpx.Timeout(HTTP_TIMEOUT),
+    )
+
+
+def init_cpu_worker() -> None:
+    """Initialize a CPU pool worker process."""
+    os.environ.setdefault("GDAL_CACHEMAX", GDAL_CACHEMAX_MB)
+    for key, value in COG_GDAL_OPTIONS.items():
+        os.environ.setdefault(key, value)
 
 
-def download_single_polygon(
-    index: int,
-    row,
-    polygon_gdf: gpd.GeoDataFrame,
+async def spool_response(response: httpx.Response, path: Path) -> Path:
+    """Stream a response body to a file on disk."""
+    with open(path, "wb") as f:
+        async for chunk in response.aiter_bytes(STREAM_CHUNK_SIZE):
+            f.write(chunk)
+    return path
+
+
+async def download_polygon_bytes(
+    client: httpx.AsyncClient,
+    semaphore: asyncio.Semaphore,
+    bbox: tuple[float, float, float, float],
+    width: int,
+    height: int,
     wcs_url: str,
     coverage_id: str,
-    output_folder: Path,
-    sleep_duration: float,
-    resolution: float,
-    max_pixels: int,
-) -> DownloadResult:
+    rate_limiter: TokenBucket | None,
+    tmp_path: Path | None = None,
+) -> bytes | Path:
     """
-    Download and mask raster for a single polygon.
+    Download the raw GeoTIFF coverage for a single polygon's bounding box.
+
+    At most `net_workers` downloads hold the semaphore at once; raises on any
+    download error. The coverage is kept in memory unless `tmp_path` is given.
 
     Args:
-        index: Polygon index from the GeoDataFrame
-        row: Row from bounds DataFrame with minx, miny, maxx, maxy
-        polygon_gdf: Original GeoDataFrame with polygon geometries
+        client: Shared async HTTP client
+        semaphore: Semaphore bounding concurrent requests
+        bbox: Bounding box (minx, miny, maxx, maxy) in EPSG:25833
+        width: Requested raster width in pixels
+        height: Requested raster height in pixels
         wcs_url: WCS service URL
         coverage_id: Coverage identifier
-        output_folder: Directory for output files
-        sleep_duration: Seconds to sleep after request
-        resolution: Output resolution in meters per pixel
-        max_pixels: Maximum pixels per dimension
+        rate_limiter: Shared limit on the request rate, or None for no limit
+        tmp_path: Optional file to spool the coverage to instead of memory
 
     Returns:
-        DownloadResult with success status and any error details
+        GeoTIFF bytes returned by the WCS service, or `tmp_path` holding them
     """
-    output_file = output_folder / f"D_{resolution}m_{index}.tif"
+    params = {
+        "SERVICE": "WCS",
+        "VERSION": "1.0.0",
+        "REQUEST": "GetCoverage",
+        "COVERAGE": coverage_id,
+        "BBOX": ",".join(str(v) for v in bbox),
+        "CRS": "EPSG:25833",
+        "FORMAT": "GeoTIFF",
+        "WIDTH": width,
+        "HEIGHT": height,
+    }
+
+    async with semaphore:
+        # Request coverage from WCS 1.0.0, retrying connection errors, timeouts
+        # and transient gateway errors
+        for attempt in range(MAX_RETRIES + 1):
+            if rate_limiter is not None:
+                await rate_limiter.acquire()
+            try:
+                async with client.stream("GET", wcs_url, params=params) as response:
+                    if response.status_code not in RETRY_STATUS_CODES or attempt == MAX_RETRIES:
+                        response.raise_for_status()
+                        if tmp_path is None:
+                            downloaded_data = await response.aread()
+                        else:
+                            downloaded_data = await spool_response(response, tmp_path)
+                        break
+            except httpx.TransportError:
+                if attempt == MAX_RETRIES:
+                    raise
+            await asyncio.sleep(RETRY_BACKOFF * 2**attempt)
+
+        # Check for WCS error response (XML error documents start with '<')
+        if tmp_path is None:
+            head = downloaded_data[:500]
+        else:
+            with open(tmp_path, "rb") as f:
+                head = f.read(500)
+        if head.startswith(b'<') or head.startswith(b'<?'):
+            error_preview = head.decode('utf-8', errors='replace')
+            raise ValueError(f"WCS returned error response: {error_preview}")
 
-    # Skip if file already exists
-    if output_file.exists():
-        return DownloadResult(index=index, success=True, skipped=True)
+    return downloaded_data
 
+
+async def process_batch(
+    client: httpx.AsyncClient,
+    semaphore: asyncio.Semaphore,
+    inflight: asyncio.Semaphore,
+    cpu_pool: ProcessPoolExecutor,
+    bbox: tuple[float, float, float, float],
+    width: int,
+    height: int,
+    members: list[BatchMember],
+    wcs_url: str,
+    coverage_id: str,
+    rate_limiter: TokenBucket | None,
+    output_dtype: str,
+    tmp_dir: Path | None,
+    tmp_slots: asyncio.Semaphore | None,
+) -> list[DownloadResult]:
+    """
+    Download one coverage and hand it to the CPU pool to mask and save each member polygon.
+
+    `inflight` is held from before the download until the CPU pool is done,
+    bounding how many coverages are held in memory while waiting for a worker.
+    With `tmp_dir` set, the coverage is spooled to a temporary file there
+    instead of memory, and `tmp_slots` bounds how many such files exist at once.
+
+    Returns:
+        One DownloadResult per member, in the same order as `members`
+    """
+    tmp_path: Path | None = None
     try:
-        # Validate bounds are not NaN (can happen with invalid geometries)
-        bounds = [row.minx, row.miny, row.maxx, row.maxy]
-        if any(math.isnan(v) for v in bounds):
-            raise ValueError(f"Invalid geometry bounds (NaN values) for polygon {index}")
-
-        wcs = get_wcs_connection(wcs_url)
-
-        # Create bbox tuple for WCS 1.0.0
-        bbox = (
-            float(row.minx),
-            float(row.miny),
-            float(row.maxx),
-            float(row.maxy),
-        )
+        async with inflight, tmp_slots or nullcontext():
+            if tmp_dir is not None:
+                with tempfile.NamedTemporaryFile(dir=tmp_dir, suffix=".tif", delete=False) as tmp:
+                    tmp_path = Path(tmp.name)
 
-        # Calculate pixel dimensions based on resolution
-        width = max(1, int((row.maxx - row.minx) / resolution))
-        height = max(1, int((row.maxy - row.miny) / resolution))
+            downloaded_data = await download_polygon_bytes(
+                client, semaphore, bbox, width, height, wcs_url, coverage_id, rate_limiter, tmp_path
+            )
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                cpu_pool, process_coverage, downloaded_data, members, output_dtype
+            )
 
-        # Prevent excessively large raster requests
-        if width > max_pixels or height > max_pixels:
-            raise ValueError(
-                f"Requested raster too large: {width}x{height} pixels. "
-                f"Max is {max_pixels}x{max_pixels}. "
-                f"Consider using a coarser resolution or increasing --max-pixels."
+    except Exception as e:
+        return [
+            DownloadResult(
+                index=member.index,
+                success=False,
+                error_type=type(e).__name__,
+                error_message=str(e),
             )
+            for member in members
+        ]
+
+    finally:
+        if tmp_path is not None:
+            tmp_path.unlink(missing_ok=True)
+
+
+async def process_source_batch(
+    cpu_pool: ProcessPoolExecutor,
+    source_cog: str,
+    resolution: float,
+    members: list[BatchMember],
+    output_dtype: str,
+) -> list[DownloadResult]:
+    """
+    Have the CPU pool read, mask and save member polygons from a source COG.
 
-        # Request coverage from WCS
-        response = wcs.getCoverage(
-            identifier=coverage_id,
-            bbox=bbox,
-            crs="EPSG:25833",
-            format="GeoTIFF",
-            width=width,
-            height=height,
+    Returns:
+        One DownloadResult per member, in the same order as `members`
+    """
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            cpu_pool, process_source_cog, source_cog, resolution, members, output_dtype
         )
 
-        downloaded_data = response.read()
+    except Exception as e:
+        return [
+            DownloadResult(
+                index=member.index,
+                success=False,
+                error_type=type(e).__name__,
+                error_message=str(e),
+            )
+            for member in members
+        ]
+
 
-        # Check for WCS error response (XML error documents start with '<')
-        if downloaded_data.startswith(b'<') or downloaded_data.startswith(b'<?'):
-            error_preview = downloaded_data[:500].decode('utf-8', errors='replace')
-            raise ValueError(f"WCS returned error response: {error_preview}")
+def open_source_cog(source_cog: str, resolution: float) -> DatasetReader | WarpedVRT:
+    """
+    Open a source COG once per worker, warped to EPSG:25833 at the output resolution if needed.
 
-        # Write to temp file, process, and clean up
-        with tempfile.NamedTemporaryFile(suffix=".tif", delete=False) as tmp:
-            tmp.write(downloaded_data)
-            temp_path = Path(tmp.name)
+    The dataset stays open for the worker's lifetime so later polygons reuse
+    its header and block cache; each polygon is then a windowed range read.
+    """
+    key = (source_cog, resolution)
+    if getattr(source_cache, "key", None) != key:
+        src = rasterio.open(source_cog)
+        target_crs = CRS.from_epsg(25833)
+        if src.crs == target_crs and np.allclose(src.res, (resolution, resolution)):
+            source_cache.dataset = src
+        else:
+            transform, width, height = calculate_default_transform(
+                src.crs, target_crs, src.width, src.height, *src.bounds, resolution=resolution
+            )
+            source_cache.dataset = WarpedVRT(
+                src,
+                crs=target_crs,
+                transform=transform,
+                width=width,
+                height=height,
+                resampling=Resampling.bilinear,
+            )
+        source_cache.key = key
+    return source_cache.dataset
 
-        try:
-            raster = gu.Raster(temp_path, load_data=True)
 
-            # Create mask from polygon geometry
-            vector = gu.Vector(polygon_gdf.loc[[index]])
-            mask = vector.create_mask(ref=raster)
+def process_source_cog(
+    source_cog: str,
+    resolution: float,
+    members: list[BatchMember],
+    output_dtype: str,
+) -> list[DownloadResult]:
+    """
+    Read, mask and save member polygons from a source COG instead of the WCS.
 
-            # Apply mask: ~mask inverts so outside polygon becomes NoData
-            raster.set_mask(~mask)
+    Runs in the CPU process pool, so all arguments are plain picklable values.
 
-            # Save output
-            raster.save(output_file)
+    Args:
+        source_cog: Path or URL of a Cloud-Optimized GeoTIFF mosaic
+        resolution: Output resolution in meters per pixel
+        members: Polygons to extract
+        output_dtype: Output data type, see OUTPUT_SCALES
+
+    Returns:
+        One DownloadResult per member, in the same order as `members`
+    """
+    try:
+        src = open_source_cog(source_cog, resolution)
+        return [mask_and_save(src, member, output_dtype) for member in members]
 
-        finally:
-            # Clean up temp file
-            temp_path.unlink(missing_ok=True)
+    except Exception as e:
+        return [
+            DownloadResult(
+                index=member.index,
+                success=False,
+                error_type=type(e).__name__,
+                error_message=str(e),
+            )
+            for member in members
+        ]
 
-        # Sleep to avoid overwhelming the server
-        if sleep_duration > 0:
-            time.sleep(sleep_duration)
 
-        return DownloadResult(index=index, success=True)
+def process_coverage(
+    downloaded_data: bytes | Path,
+    members: list[BatchMember],
+    output_dtype: str,
+) -> list[DownloadResult]:
+    """
+    Decode a downloaded coverage once and mask and save every member polygon from it.
+
+    Runs in the CPU process pool, so all arguments are plain picklable values.
+
+    Args:
+        downloaded_data: GeoTIFF bytes from the WCS service, or a file holding them
+        members: Polygons whose bounding boxes lie within the coverage
+        output_dtype: Output data type, see OUTPUT_SCALES
+
+    Returns:
+        One DownloadResult per member, in the same order as `members`
+    """
+    try:
+        if isinstance(downloaded_data, Path):
+            with rasterio.open(downloaded_data) as src:
+                return [mask_and_save(src, member, output_dtype) for member in members]
+
+        # Decode in memory (no temp file roundtrip); MemoryFile wraps bytes without copying
+        with MemoryFile(downloaded_data) as memfile:
+            with memfile.open() as src:
+                return [mask_and_save(src, member, output_dtype) for member in members]
+
+    except Exception as e:
+        return [
+            DownloadResult(
+                index=member.index,
+                success=False,
+                error_type=type(e).__name__,
+                error_message=str(e),
+            )
+            for member in members
+        ]
+
+
+def mask_and_save(src: DatasetReader, member: BatchMember, output_dtype: str) -> DownloadResult:
+    """
+    Read a polygon's window from an open coverage, mask it and save it.
+
+    Works on the raw array with rasterio; pixels outside the polygon are set
+    to NoData.
+
+    Args:
+        src: Open coverage dataset covering the polygon's bounding box
+        member: Polygon to extract
+        output_dtype: Output data type, see OUTPUT_SCALES
+
+    Returns:
+        DownloadResult with success status and any error details
+    """
+    try:
+        window = polygon_window(member.bbox, src.transform, src.width, src.height)
+        shape = (int(window.height), int(window.width))
+        data = src.read(1, window=window, out=get_buffer(shape, src.dtypes[0]))
+        transform = src.window_transform(window)
+        nodata = src.nodata if src.nodata is not None else DEFAULT_NODATA
+
+        # Pixels outside the polygon become NoData. Rectangles covering every
+        # pixel center need no mask at all.
+        polygon = shapely.from_wkb(member.polygon_wkb)
+        outside = None
+        if not fills_window(polygon, transform, shape):
+            inside = get_buffer(shape, np.uint8)
+            inside.fill(0)
+            rasterize([(polygon, 1)], out=inside, transform=transform)
+            outside = np.equal(inside, 0, out=get_buffer(shape, np.bool_))
+            np.copyto(data, nodata, where=outside)
+
+        # Optionally store heights as scaled integers
+        scale = OUTPUT_SCALES.get(output_dtype)
+        if scale is not None:
+            nodata_mask = data == nodata
+            if outside is not None:
+                nodata_mask |= outside
+            data = quantize(data, nodata_mask, scale, output_dtype)
+            nodata = np.iinfo(output_dtype).min
+
+        # Save output as a tiled, compressed GeoTIFF with overviews
+        profile = {
+            "driver": "GTiff",
+            "width": data.shape[1],
+            "height": data.shape[0],
+            "count": 1,
+            "dtype": data.dtype,
+            "crs": src.crs,
+            "transform": transform,
+            "nodata": nodata,
+            "tiled": True,
+            "blockxsize": BLOCK_SIZE,
+            "blockysize": BLOCK_SIZE,
+            "compress": "DEFLATE",
+            "predictor": 3 if np.issubdtype(data.dtype, np.floating) else 2,
+            "BIGTIFF": "IF_SAFER",
+        }
+        with rasterio.open(member.output_file, "w", **profile) as dst:
+            dst.write(data, 1)
+
+            # Internal overviews down to roughly one block
+            factors = [f for f in OVERVIEW_FACTORS if max(data.shape) * 2 / f > BLOCK_SIZE]
+            if factors:
+                dst.build_overviews(factors, Resampling.average)
+                dst.update_tags(ns="rio_overview", resampling="average")
+            if scale is not None:
+                dst.scales = (scale,)
+                dst.offsets = (0.0,)
+                dst.update_tags(scale=scale, offset=0)
+
+        return DownloadResult(index=member.index, success=True)
 
     except Exception as e:
         return DownloadResult(
-            index=index,
+            index=member.index,
             success=False,
             error_type=type(e).__name__,
             error_message=str(e),
         )
 
 
-def write_error_log(failed: list[FailedPolygon], output_folder: Path) -> Path:
-    """Write failed polygons to CSV file."""
-    error_log_path = output_folder / "failed_polygons.csv"
+def polygon_window(
+    bbox: tuple[float, float, float, float],
+    transform: Affine,
+    width: int,
+    height: int,
+) -> Window:
+    """
+    Window of whole pixels covering a bounding box, clipped to the raster.
+
+    Offsets round down and ends round up, so every pixel the box touches is
+    included, and the window is at least one pixel in each dimension.
+    Raises WindowError if the box lies outside the raster.
+    """
+    window = from_bounds(*bbox, transform=transform)
+    col0 = math.floor(window.col_off + PIXEL_EPSILON)
+    row0 = math.floor(window.row_off + PIXEL_EPSILON)
+    col1 = max(col0 + 1, math.ceil(window.col_off + window.width - PIXEL_EPSILON))
+    row1 = max(row0 + 1, math.ceil(window.row_off + window.height - PIXEL_EPSILON))
+    return Window(col0, row0, col1 - col0, row1 - row0).intersection(Window(0, 0, width, height))
 
-    with open(error_log_path, "w", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerow(
-            ["index", "minx", "miny", "maxx", "maxy", "error_type", "error_message", "timestamp"]
-        )
-        for fp in failed:
-            writer.writerow(
-                [fp.index, fp.minx, fp.miny, fp.maxx, fp.maxy, fp.error_type, fp.error_message, fp.timestamp]
+
+def get_buffer(shape: tuple[int, int], dtype: npt.DTypeLike) -> np.ndarray:
+    """
+    Get a reusable array of the given shape and dtype for the current worker.
+
+    Polygons often share a raster size, so reusing arrays avoids a fresh
+    allocation (and page faults) per polygon. Only the most recently used
+    BUFFER_CACHE_SIZE arrays are kept. Contents are undefined on return.
+    """
+    cache = getattr(buffer_cache, "arrays", None)
+    if cache is None:
+        cache = buffer_cache.arrays = OrderedDict()
+
+    key = (shape, np.dtype(dtype).str)
+    buffer = cache.pop(key, None)
+    if buffer is None:
+        buffer = np.empty(shape, dtype=dtype)
+    cache[key] = buffer
+
+    while len(cache) > BUFFER_CACHE_SIZE:
+        cache.popitem(last=False)
+    return buffer
+
+
+def fills_window(polygon: shapely.Geometry, transform: Affine, shape: tuple[int, int]) -> bool:
+    """
+    Check whether every pixel center of a raster lies inside the polygon.
+
+    Only true for polygons that exactly fill their bounding box (axis-aligned
+    rectangles, e.g. grid tiles) when that box spans all pixel centers.
+    """
+    if polygon.geom_type != "Polygon":
+        return False
+    minx, miny, maxx, maxy = polygon.bounds
+    if not math.isclose(polygon.area, (maxx - minx) * (maxy - miny), rel_tol=1e-9):
+        return False
+
+    height, width = shape
+    first_x, first_y = transform * (0.5, 0.5)
+    last_x, last_y = transform * (width - 0.5, height - 0.5)
+    return (
+        minx < min(first_x, last_x)
+        and max(first_x, last_x) < maxx
+        and miny < min(first_y, last_y)
+        and max(first_y, last_y) < maxy
+    )
+
+
+def quantize(data: np.ndarray, nodata_mask: np.ndarray, scale: float, dtype: str) -> np.ndarray:
+    """
+    Convert heights to integers in units of `scale`, reserving the type's minimum as NoData.
+
+    Values outside the integer range are clipped; NaN heights become NoData.
+    """
+    info = np.iinfo(dtype)
+    nodata_mask = nodata_mask | np.isnan(data)
+    with np.errstate(invalid="ignore"):
+        quantized = np.clip(np.round(data / scale), info.min + 1, info.max).astype(dtype)
+    np.copyto(quantized, info.min, where=nodata_mask)
+    return quantized
+
+
+def hilbert_distance(x: np.ndarray, y: np.ndarray, order: int) -> np.ndarray:
+    """Distance along a Hilbert curve for integer grid coordinates in [0, 2**order)."""
+    n = 1 << order
+    x = x.astype(np.int64)
+    y = y.astype(np.int64)
+    d = np.zeros_like(x)
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant so the curve stays continuous
+        flip = ~ry & rx
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        x, y = np.where(~ry, y, x), np.where(~ry, x, y)
+        s >>= 1
+    return d
+
+
+def group_polygons(
+    bounds: np.ndarray,
+    positions: np.ndarray,
+    resolution: float,
+    batch_pixels: int,
+) -> list[list[int]]:
+    """
+    Greedily pack nearby polygons into groups that share one WCS request.
+
+    Polygons are visited in Hilbert order of their bounding box centers, and
+    each is added to the current group while the group's union bounding box
+    stays within `batch_pixels` in both dimensions.
+
+    Args:
+        bounds: (n, 4) array of minx, miny, maxx, maxy for all polygons
+        positions: Row positions of the polygons to group
+        resolution: Output resolution in meters per pixel
+        batch_pixels: Maximum pixels per dimension of a group's request
+
+    Returns:
+        List of groups, each a list of row positions
+    """
+    if batch_pixels <= 0 or len(positions) == 0:
+        return [[pos] for pos in positions]
+
+    # Order polygons along a Hilbert curve so consecutive ones are spatially close
+    centers = (bounds[positions, :2] + bounds[positions, 2:]) / 2
+    origin = centers.min(axis=0)
+    extent = max(float((centers.max(axis=0) - origin).max()), resolution)
+    order = 16
+    grid = ((centers - origin) / extent * ((1 << order) - 1)).astype(np.int64)
+    ordered = positions[np.argsort(hilbert_distance(grid[:, 0], grid[:, 1], order), kind="stable")]
+
+    max_span = batch_pixels * resolution
+    groups: list[list[int]] = []
+    current: list[int] = []
+    union = np.empty(4)
+    for pos in ordered:
+        minx, miny, maxx, maxy = bounds[pos]
+        if current:
+            candidate = (
+                min(union[0], minx),
+                min(union[1], miny),
+                max(union[2], maxx),
+                max(union[3], maxy),
             )
+            if candidate[2] - candidate[0] <= max_span and candidate[3] - candidate[1] <= max_span:
+                current.append(pos)
+                union[:] = candidate
+                continue
+            groups.append(current)
+        current = [pos]
+        union[:] = (minx, miny, maxx, maxy)
+    groups.append(current)
+
+    return groups
+
+
+def load_polygons(input_parquet: Path) -> tuple[np.ndarray, np.ndarray, CRS | None]:
+    """
+    Load polygon geometries, their row indices and CRS from a GeoParquet file.
+
+    Only the geometry and index columns are read, with pyarrow, and the WKB
+    is decoded in one vectorized shapely call. Files this does not handle
+    (missing GeoParquet metadata, non-WKB geometry encodings, multi-level
+    indexes) are read with geopandas, which also reports invalid files.
+
+    Returns:
+        Tuple of (indices, geometries, crs)
+    """
+    schema = pq.read_schema(input_parquet)
+    metadata = schema.metadata or {}
+    geo = json.loads(metadata.get(b"geo", b"{}"))
+    pandas_meta = json.loads(metadata.get(b"pandas", b"null")) or {}
+
+    column = geo.get("primary_column", "geometry")
+    column_meta = geo.get("columns", {}).get(column, {})
+    index_columns = pandas_meta.get("index_columns", [])
+
+    is_wkb = column_meta.get("encoding", "WKB").upper() == "WKB"
+    if b"geo" not in metadata or column not in schema.names or not is_wkb or len(index_columns) > 1:
+        polygon_gdf = gpd.read_parquet(input_parquet)
+        return polygon_gdf.index.to_numpy(), polygon_gdf.geometry.to_numpy(), polygon_gdf.crs
+
+    index_column = index_columns[0] if index_columns and isinstance(index_columns[0], str) else None
+    table = pq.read_table(input_parquet, columns=[column] + ([index_column] if index_column else []))
+    geometries = shapely.from_wkb(table.column(column).to_numpy(zero_copy_only=False))
+
+    # Restore the pandas index so output names match the input rows
+    if index_column is not None:
+        indices = table.column(index_column).to_numpy(zero_copy_only=False)
+    elif index_columns:
+        index_range = index_columns[0]
+        indices = np.arange(index_range["start"], index_range["stop"], index_range["step"])
+    else:
+        indices = np.arange(len(geometries))
+
+    # GeoParquet: a missing crs means OGC:CRS84, an explicit null means unknown
+    if "crs" not in column_meta:
+        crs = CRS.from_user_input("OGC:CRS84")
+    elif column_meta["crs"] is None:
+        crs = None
+    else:
+        crs = CRS.from_user_input(column_meta["crs"])
+
+    return indices, geometries, crs
+
+
+def reproject_geometries(geometries: np.ndarray, source_crs: CRS, target_crs: CRS) -> np.ndarray:
+    """
+    Reproject an array of geometries with a single batched coordinate transform.
+
+    All coordinates are extracted into one array, transformed in one pyproj
+    call and written back, instead of transforming geometry by geometry.
+    """
+    transformer = Transformer.from_crs(source_crs, target_crs, always_xy=True)
+    geometries = shapely.force_2d(geometries)
+    coords = shapely.get_coordinates(geometries)
+    xs, ys = transformer.transform(coords[:, 0], coords[:, 1])
+    return shapely.set_coordinates(geometries.copy(), np.column_stack([xs, ys]))
+
+
+class ErrorLog:
+    """
+    CSV log of failed polygons, appended and flushed one row at a time.
+
+    Failures survive a crash mid-run, and no failure list is kept in memory.
+    The file is only created once the first failure is written.
+    """
+
+    header = ["index", "minx", "miny", "maxx", "maxy", "error_type", "error_message", "timestamp"]
+
+    def __init__(self, path: Path, append: bool) -> None:
+        self.path = path
+        self.append = append and path.exists()
+        self.file = None
+        self.writer = None
+
+    def write(self, fp: FailedPolygon) -> None:
+        """Append one failed polygon and flush it to disk."""
+        if self.writer is None:
+            self.file = open(self.path, "a" if self.append else "w", newline="", encoding="utf-8")
+            self.writer = csv.writer(self.file)
+            if not self.append:
+                self.writer.writerow(self.header)
+        self.writer.writerow(
+            [fp.index, fp.minx, fp.miny, fp.maxx, fp.maxy, fp.error_type, fp.error_message, fp.timestamp]
+        )
+        self.file.flush()
+
+    def close(self) -> None:
+        """Close the log file if it was opened."""
+        if self.file is not None:
+            self.file.close()
 
-    return error_log_path
+    def __enter__(self) -> "ErrorLog":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def read_failed_indices(error_log_path: Path) -> set[str]:
+    """Read the polygon indices listed in an existing error log."""
+    if not error_log_path.exists():
+        return set()
+    with open(error_log_path, newline="", encoding="utf-8") as f:
+        return {row["index"] for row in csv.DictReader(f)}
 
 
 def process_polygons(
     input_parquet: Path,
     output_dir: Path,
-    workers: int,
-    sleep_duration: float,
+    net_workers: int,
+    cpu_workers: int,
+    rate: float,
     wcs_url: str,
     coverage_id: str,
     resolution: float,
     max_pixels: int,
-) -> tuple[int, int, int, list[FailedPolygon]]:
+    batch_pixels: int,
+    output_dtype: str,
+    tmp_dir: Path | None,
+    source_cog: str | None,
+    skip_failed: bool,
+) -> tuple[int, int, int, int, list[FailedPolygon]]:
     """
     Process all polygons with parallel downloads.
 
+    Failed polygons are written to the error log as they happen.
+
     Returns:
-        Tuple of (completed_count, skipped_count, failed_count, failed_list)
+        Tuple of (completed_count, skipped_count, skipped_failed_count, failed_count, first_failures)
     """
     # Load polygon data
     console.print(f"[blue]Loading polygons from {input_parquet}...[/blue]")
-    polygon_gdf = gpd.read_parquet(input_parquet)
+    indices, geometries, source_crs = load_polygons(input_parquet)
 
     # Reproject to EPSG:25833 if needed (WCS expects UTM coordinates)
     target_crs = CRS.from_epsg(25833)
-    if polygon_gdf.crs is None:
+    if source_crs is None:
         console.print("[yellow]Warning: No CRS found, assuming EPSG:25833[/yellow]")
-        polygon_gdf = polygon_gdf.set_crs("EPSG:25833")
-    elif not polygon_gdf.crs.equals(target_crs):
-        console.print(f"[yellow]Reprojecting from {polygon_gdf.crs} to EPSG:25833...[/yellow]")
-        polygon_gdf = polygon_gdf.to_crs("EPSG:25833")
-
-    bounds_df = polygon_gdf.bounds
+    elif not source_crs.equals(target_crs):
+        console.print(f"[yellow]Reprojecting from {source_crs.to_string()} to EPSG:25833...[/yellow]")
+        geometries = reproject_geometries(geometries, source_crs, target_crs)
 
-    total = len(bounds_df)
+    total = len(geometries)
     console.print(f"[green]Found {total} polygons to process[/green]")
 
     # Ensure output directory exists
     output_dir.mkdir(parents=True, exist_ok=True)
 
+    # Compute pixel dimensions and validity for all polygons at once
+    bounds = shapely.bounds(geometries)
+    nan_rows = ~np.isfinite(bounds).all(axis=1)
+    with np.errstate(invalid="ignore"):
+        spans = np.where(nan_rows[:, None], 0.0, bounds[:, 2:] - bounds[:, :2])
+    pixels = np.maximum(1, (spans / resolution).astype(np.int64))
+    widths, heights = pixels[:, 0], pixels[:, 1]
+    too_large = (widths > max_pixels) | (heights > max_pixels)
+    valid = ~nan_rows & ~too_large
+
+    output_files = [output_dir / f"D_{resolution}m_{index}.tif" for index in indices]
+
+    # On resume, optionally skip polygons that failed in an earlier run.
+    # Otherwise they are retried and the log starts over.
+    error_log_path = output_dir / ERROR_LOG_NAME
+    failed_before = read_failed_indices(error_log_path) if skip_failed else set()
+    if failed_before:
+        console.print(f"[yellow]Skipping {len(failed_before)} polygons listed in {error_log_path}[/yellow]")
+    elif error_log_path.exists():
+        error_log_path.unlink()
+
     completed = 0
     skipped = 0
+    skipped_failed = 0
     failed_count = 0
-    failed_polygons: list[FailedPolygon] = []
+    failed_preview: list[FailedPolygon] = []
 
-    with Progress(
+    with ErrorLog(error_log_path, append=bool(failed_before)) as error_log, Progress(
         SpinnerColumn(),
         TextColumn("[progress.description]{task.description}"),
         BarColumn(),
@@ -264,63 +922,175 @@ def process_polygons(
     ) as progress:
         task = progress.add_task("[cyan]Downloading rasters...", total=total)
 
-        with ThreadPoolExecutor(max_workers=workers) as executor:
-            # Submit all tasks
-            futures = {
-                executor.submit(
-                    download_single_polygon,
-                    row.Index,
-                    row,
-                    polygon_gdf,
-                    wcs_url,
-                    coverage_id,
-                    output_dir,
-                    sleep_duration,
-                    resolution,
-                    max_pixels,
-                ): row
-                for row in bounds_df.itertuples()
-            }
-
-            # Process results as they complete
-            for future in as_completed(futures):
-                row = futures[future]
-                result = future.result()
-
-                if result.skipped:
-                    skipped += 1
-                elif result.success:
-                    completed += 1
-                else:
-                    failed_count += 1
-                    failed_polygons.append(
-                        FailedPolygon(
-                            index=result.index,
-                            minx=row.minx,
-                            miny=row.miny,
-                            maxx=row.maxx,
-                            maxy=row.maxy,
-                            error_type=result.error_type or "Unknown",
-                            error_message=result.error_message or "Unknown error",
-                        )
-                    )
+        def record(pos: int, result: DownloadResult) -> None:
+            nonlocal completed, skipped, skipped_failed, failed_count
+
+            # Skipped results are successful for existing files and
+            # unsuccessful for polygons that failed in an earlier run
+            if result.skipped and result.success:
+                skipped += 1
+            elif result.skipped:
+                skipped_failed += 1
+            elif result.success:
+                completed += 1
+            else:
+                failed_count += 1
+                minx, miny, maxx, maxy = bounds[pos]
+                failed = FailedPolygon(
+                    index=result.index,
+                    minx=minx,
+                    miny=miny,
+                    maxx=maxx,
+                    maxy=maxy,
+                    error_type=result.error_type or "Unknown",
+                    error_message=result.error_message or "Unknown error",
+                )
+                error_log.write(failed)
+                if len(failed_preview) < FAILED_PREVIEW_LIMIT:
+                    failed_preview.append(failed)
+
+            progress.update(task, advance=1)
+            progress.update(
+                task,
+                description=f"[cyan]Downloading... [green]✓{completed}[/green] [yellow]⏭{skipped + skipped_failed}[/yellow] [red]✗{failed_count}[/red]",
+            )
 
-                progress.update(task, advance=1)
-                progress.update(
-                    task,
-                    description=f"[cyan]Downloading... [green]✓{completed}[/green] [yellow]⏭{skipped}[/yellow] [red]✗{failed_count}[/red]",
+        # Invalid geometries (NaN or infinite bounds) and oversized requests are never submitted
+        for pos in np.flatnonzero(~valid):
+            index = indices[pos]
+            if str(index) in failed_before:
+                record(pos, DownloadResult(index=index, success=False, skipped=True))
+                continue
+            if nan_rows[pos]:
+                error_message = f"Invalid geometry bounds (NaN values) for polygon {index}"
+            else:
+                error_message = (
+                    f"Requested raster too large: {widths[pos]}x{heights[pos]} pixels. "
+                    f"Max is {max_pixels}x{max_pixels}. "
+                    f"Consider using a coarser resolution or increasing --max-pixels."
+                )
+            record(pos, DownloadResult(index=index, success=False, error_type="ValueError", error_message=error_message))
+
+        # Skip polygons whose output file already exists or that failed before
+        to_download = []
+        for pos in np.flatnonzero(valid):
+            if output_files[pos].exists():
+                record(pos, DownloadResult(index=indices[pos], success=True, skipped=True))
+            elif str(indices[pos]) in failed_before:
+                record(pos, DownloadResult(index=indices[pos], success=False, skipped=True))
+            else:
+                to_download.append(pos)
+
+        to_download = np.array(to_download, dtype=np.int64)
+        groups = group_polygons(bounds, to_download, resolution, min(batch_pixels, max_pixels))
+
+        # Serialize the geometries to download once, in one vectorized call, so
+        # each CPU worker only receives WKB for its own polygons
+        geometry_wkb: dict[int, bytes] = dict(zip(to_download.tolist(), shapely.to_wkb(geometries[to_download])))
+
+        # One WCS request per group: bbox and pixel size of the coverage to fetch
+        coverage_requests = []
+        for group in groups:
+            if len(group) == 1:
+                pos = group[0]
+                bbox = tuple(float(v) for v in bounds[pos])
+                width, height = int(widths[pos]), int(heights[pos])
+            else:
+                # Union bounding box, grown from its top-left corner to whole pixels
+                minx, miny = bounds[group, :2].min(axis=0)
+                maxx, maxy = bounds[group, 2:].max(axis=0)
+                width = max(1, math.ceil((maxx - minx) / resolution))
+                height = max(1, math.ceil((maxy - miny) / resolution))
+                bbox = (
+                    float(minx),
+                    float(maxy - height * resolution),
+                    float(minx + width * resolution),
+                    float(maxy),
                 )
+            coverage_requests.append((group, bbox, width, height))
+
+        # Bound concurrent temp files by the free space in tmp_dir
+        if tmp_dir is not None and source_cog is None and coverage_requests:
+            tmp_dir.mkdir(parents=True, exist_ok=True)
+            largest_pixels = max(width * height for _, _, width, height in coverage_requests)
+            largest_coverage = largest_pixels * COVERAGE_BYTES_PER_PIXEL
+            tmp_slot_count = max(1, shutil.disk_usage(tmp_dir).free // largest_coverage)
+        else:
+            tmp_slot_count = None
+
+        async def run_pipeline(cpu_pool: ProcessPoolExecutor) -> None:
+            semaphore = asyncio.Semaphore(net_workers)
+            inflight = asyncio.Semaphore(net_workers + cpu_workers)
+            # Capacity of at least one token, otherwise slow rates never allow a request
+            rate_limiter = TokenBucket(rate, capacity=max(1.0, 2 * rate)) if rate > 0 else None
+            tmp_slots = asyncio.Semaphore(tmp_slot_count) if tmp_slot_count else None
+            async with create_client(net_workers) if source_cog is None else nullcontext() as client:
+                pending: dict[asyncio.Task, list[int]] = {}
+
+                for group, bbox, width, height in coverage_requests:
+                    members = [
+                        BatchMember(
+                            index=indices[pos],
+                            bbox=tuple(float(v) for v in bounds[pos]),
+                            polygon_wkb=geometry_wkb[pos],
+                            output_file=output_files[pos],
+                        )
+                        for pos in group
+                    ]
+                    if source_cog is not None:
+                        batch = process_source_batch(cpu_pool, source_cog, resolution, members, output_dtype)
+                    else:
+                        batch = process_batch(
+                            client,
+                            semaphore,
+                            inflight,
+                            cpu_pool,
+                            bbox,
+                            width,
+                            height,
+                            members,
+                            wcs_url,
+                            coverage_id,
+                            rate_limiter,
+                            output_dtype,
+                            tmp_dir,
+                            tmp_slots,
+                        )
+                    future = asyncio.create_task(batch)
+                    pending[future] = group
+
+                # Process results as they complete
+                while pending:
+                    done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for future in done:
+                        for pos, result in zip(pending.pop(future), future.result()):
+                            record(pos, result)
 
-    return completed, skipped, failed_count, failed_polygons
+        # Two-stage pipeline with independently sized stages: net_workers
+        # concurrent async downloads (network-bound) feeding cpu_workers
+        # processes that decode, mask and save (CPU-bound). At most
+        # net_workers + cpu_workers coverages are in flight. With a source COG
+        # the workers read their windows directly and the WCS is skipped, so
+        # concurrency is cpu_workers alone.
+        with ProcessPoolExecutor(max_workers=cpu_workers, initializer=init_cpu_worker) as cpu_pool:
+            asyncio.run(run_pipeline(cpu_pool))
+
+    return completed, skipped, skipped_failed, failed_count, failed_preview
 
 
 def main(
     input_parquet: Annotated[Path, typer.Argument(help="Path to parquet file with polygon geometries")],
     output_dir: Annotated[Path, typer.Argument(help="Directory for output GeoTIFF files")],
-    workers: Annotated[int, typer.Option("--workers", "-w", help="Number of parallel workers")] = 4,
-    sleep: Annotated[float, typer.Option("--sleep", "-s", help="Seconds to sleep between requests per worker")] = 0.5,
+    net_workers: Annotated[int, typer.Option("--net-workers", "--workers", "-w", help="Number of concurrent downloads")] = DEFAULT_NET_WORKERS,
+    cpu_workers: Annotated[int, typer.Option("--cpu-workers", "-c", help="Number of processes for masking and saving")] = DEFAULT_CPU_WORKERS,
+    rate: Annotated[float | None, typer.Option("--rate", help="Maximum WCS requests per second across all workers, 0 for no limit [default: 2 x net workers]")] = None,
     resolution: Annotated[float, typer.Option("--resolution", "-r", help="Output resolution in meters per pixel")] = 1.0,
     max_pixels: Annotated[int, typer.Option("--max-pixels", "-m", help="Maximum pixels per dimension")] = DEFAULT_MAX_PIXELS,
+    batch_pixels: Annotated[int, typer.Option("--batch-pixels", "-b", help="Batch nearby polygons into requests of up to this many pixels per dimension (0 disables)")] = DEFAULT_BATCH_PIXELS,
+    output_dtype: Annotated[OutputDtype, typer.Option("--output-dtype", "-t", help="Output data type (int16 stores heights in decimetres)")] = OutputDtype.float32,
+    skip_failed: Annotated[bool, typer.Option("--skip-failed", help="Also skip polygons listed in an existing failed_polygons.csv")] = False,
+    tmp_dir: Annotated[Path | None, typer.Option("--tmp-dir", help="Spool downloads to temporary files in this directory instead of memory")] = None,
+    source_cog: Annotated[str | None, typer.Option("--source-cog", help="Read from this Cloud-Optimized GeoTIFF (path or URL) instead of the WCS")] = None,
     wcs_url: Annotated[str, typer.Option("--wcs-url", help="WCS service URL")] = "https://wcs.geonorge.no/skwms1/wcs.hoyde-dtm-nhm-25833",
     coverage_id: Annotated[str, typer.Option("--coverage-id", help="Coverage identifier")] = "nhm_dtm_topo_25833",
 ) -> None:
@@ -330,15 +1100,27 @@ def main(
     Supports parallel processing, automatic resume (skips existing files),
     and logs failed polygons to a CSV file.
     """
+    if rate is None:
+        rate = DEFAULT_RATE_PER_WORKER * net_workers
+
     console.print()
     console.print("[bold blue]WCS Raster Downloader[/bold blue]")
     console.print("=" * 40)
     console.print(f"Input:      {input_parquet}")
     console.print(f"Output:     {output_dir}")
-    console.print(f"Workers:    {workers}")
-    console.print(f"Sleep:      {sleep}s")
+    if source_cog is None:
+        console.print(f"Downloads:  {net_workers}")
+    console.print(f"Processes:  {cpu_workers}")
+    if source_cog is None:
+        console.print(f"Rate limit: {f'{rate:g} req/s' if rate > 0 else 'off'}")
     console.print(f"Resolution: {resolution}m")
     console.print(f"Max pixels: {max_pixels}")
+    console.print(f"Data type:  {output_dtype.value}")
+    console.print(f"Batching:   {f'{batch_pixels} px' if batch_pixels > 0 else 'off'}")
+    if tmp_dir is not None:
+        console.print(f"Temp dir:   {tmp_dir}")
+    if source_cog is not None:
+        console.print(f"Source COG: {source_cog}")
     console.print()
 
     if not input_parquet.exists():
@@ -346,15 +1128,21 @@ def main(
         raise typer.Exit(1)
 
     # Process all polygons
-    completed, skipped, failed_count, failed_polygons = process_polygons(
+    completed, skipped, skipped_failed, failed_count, failed_preview = process_polygons(
         input_parquet=input_parquet,
         output_dir=output_dir,
-        workers=workers,
-        sleep_duration=sleep,
+        net_workers=net_workers,
+        cpu_workers=cpu_workers,
+        rate=rate,
         wcs_url=wcs_url,
         coverage_id=coverage_id,
         resolution=resolution,
         max_pixels=max_pixels,
+        batch_pixels=batch_pixels,
+        output_dtype=output_dtype.value,
+        tmp_dir=tmp_dir,
+        source_cog=source_cog,
+        skip_failed=skip_failed,
     )
 
     # Print summary
@@ -364,24 +1152,25 @@ def main(
     table.add_column("Count", justify="right")
     table.add_row("[green]Completed[/green]", str(completed))
     table.add_row("[yellow]Skipped (existing)[/yellow]", str(skipped))
+    if skip_failed:
+        table.add_row("[yellow]Skipped (failed before)[/yellow]", str(skipped_failed))
     table.add_row("[red]Failed[/red]", str(failed_count))
-    table.add_row("[bold]Total[/bold]", str(completed + skipped + failed_count))
+    table.add_row("[bold]Total[/bold]", str(completed + skipped + skipped_failed + failed_count))
     console.print(table)
 
-    # Write error log if there were failures
-    if failed_polygons:
-        error_log_path = write_error_log(failed_polygons, output_dir)
+    # Point to the error log if there were failures
+    if failed_count:
         console.print()
-        console.print(f"[red]Failed polygons logged to: {error_log_path}[/red]")
+        console.print(f"[red]Failed polygons logged to: {output_dir / ERROR_LOG_NAME}[/red]")
 
-        # Show first few failures
-        if len(failed_polygons) <= 5:
+        # Show failures if there are only a few
+        if failed_count <= FAILED_PREVIEW_LIMIT:
             console.print()
             error_table = Table(title="Failed Polygons")
             error_table.add_column("Index")
             error_table.add_column("Error Type")
             error_table.add_column("Message")
-            for fp in failed_polygons:
+            for fp in failed_preview:
                 error_table.add_row(str(fp.index), fp.error_type, fp.error_message[:50])
             console.print(error_table)
 